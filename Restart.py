@@ -2,6 +2,12 @@
 This module is to be used in conjunction with PArFlow-CLM. It is still very
 much under constrcution and should NOT be fully trusted yet. It's purpose is
 to restart ParFlow using the CLM restart files. 
+
+restart_interval is in hours of model time and dump_interval is the run
+script's dump_interval (hours between pressure files); pressure files are
+numbered by dump, so a restart advances restart_interval / dump_interval files.
+Give run_name when several runs (e.g. realizations) share parflow_path, and a
+restart_path and clm_path of their own.
 '''
 
 #------------------------------------------------------------------------------
@@ -9,112 +15,332 @@ to restart ParFlow using the CLM restart files.
 #------------------------------------------------------------------------------
 
 import os
-import numpy as np
-import pandas as pd
-import glob 
+import fcntl
+import json
+import shutil
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache
+from typing import NamedTuple
 
 
 #------------------------------------------------------------------------------
-# Create an object for all intents and purposes; some evil, some good 
+# ParFlow and CLM output file naming
 #------------------------------------------------------------------------------
 
-class RestartObject:
-    def __init__(self, \
-        start_time, end_time, \
-        restart_interval = 2190, \
-        restart_path = '../restart-files/', \
-        parflow_path = '../pf-output/', \
-        clm_path = '../clm-output/'):
+PRESS_INFIX = '.out.press.'
+PFB_SUFFIX = '.pfb'
+CLM_RESTART_PREFIX = 'clm.rst.'
+
+
+#------------------------------------------------------------------------------
+# Time strings (ISO 8601, e.g. YYYY-MM-DD HH:MM) are parsed once each
+#------------------------------------------------------------------------------
+
+@lru_cache(maxsize = None)
+def _parse_time(time_string):
+    return datetime.fromisoformat(time_string)
+
+
+#------------------------------------------------------------------------------
+# Check path arguments are strings (before they reach the lru_cache, which
+# would raise TypeError on an unhashable value)
+#------------------------------------------------------------------------------
+
+def _check_paths(**paths):
+
+    for name, path in paths.items():
+        if(not isinstance(path, str)):
+            raise RuntimeError(name + ' must be a string')
+
+
+#------------------------------------------------------------------------------
+# Return the first file in a directory named prefix...suffix; one pass, no list
+#------------------------------------------------------------------------------
+
+def _first_match(dirpath, prefix, suffix):
+    with os.scandir(dirpath) as entries:
+        return next((e.path for e in entries \
+                     if e.name.startswith(prefix) and e.name.endswith(suffix)), None)
+
+
+#------------------------------------------------------------------------------
+# Read only the 64-byte PFB header (big-endian): x, y, z, nx, ny, nz, dx, dy,
+# dz and the number of subgrids
+#------------------------------------------------------------------------------
+
+PFB_HEADER = struct.Struct('>3d3i3di')
+
+def _read_pfb_header(path):
+    with open(path, 'rb') as f:
+        return PFB_HEADER.unpack(f.read(PFB_HEADER.size))
+
+
+#------------------------------------------------------------------------------
+# A complete PFB is the header, a 36-byte header per subgrid and 8 bytes/cell
+#------------------------------------------------------------------------------
+
+def _is_complete_pfb(path):
+
+    try:
+        header = _read_pfb_header(path)
+    except struct.error:
+        return False
+
+    nx, ny, nz, subgrids = header[3], header[4], header[5], header[9]
+    expected = PFB_HEADER.size + 36 * subgrids + 8 * nx * ny * nz
+    return os.path.getsize(path) == expected
+
+
+#------------------------------------------------------------------------------
+# Snapshot a file without copying its data where the filesystem allows it:
+# reflink (FICLONE on btrfs/XFS), then a plain copy. Never hard link - ParFlow
+# and CLM rewrite their output in place when a segment is re-run, which would
+# change the snapshot through the link.
+#------------------------------------------------------------------------------
+
+FICLONE = 0x40049409
+
+def fast_snapshot(src, dst):
+
+    if(os.path.lexists(dst)):
+        os.remove(dst)
+
+    try:
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        shutil.copystat(src, dst)
+        return
+    except OSError:
+        pass
+
+    shutil.copy2(src, dst)
+
+
+#------------------------------------------------------------------------------
+# Snapshot (source, destination) pairs concurrently
+#------------------------------------------------------------------------------
+
+def _copy_many(copies, max_workers = 8):
+    with ThreadPoolExecutor(max_workers = max_workers) as executor:
+        list(executor.map(lambda copy: fast_snapshot(*copy), copies))
+
+
+#------------------------------------------------------------------------------
+# Validated restart settings; paths are checked once per distinct set
+#------------------------------------------------------------------------------
+
+class RestartConfig(NamedTuple):
+    start: datetime
+    end: datetime
+    restart_interval: int
+    dump_interval: int
+    restart_path: str
+    parflow_path: str
+    clm_path: str
+    restart_log_path: str
+    last_step_path: str
+    run_name: str
+
 
+@lru_cache(maxsize = 8)
+def _validate_paths(*paths):
 
-        #----------------------------------------------------------------------
-        # Check date datetime inputs
-        #----------------------------------------------------------------------
-        
-        if(isinstance(start_time, str) and isinstance(end_time, str)):
-            self.start = datetime.strptime(start_time, '%Y-%m-%D %H:%M')
-            self.end = datetime.strptime(end_time, '%Y-%m-%D %H:%M')
+    for path in paths:
+        os.makedirs(path, exist_ok = True)
 
-        else: 
-            raise RuntimeError('Starting time and ending time must be '\
-            'individual strings formatted (UTC): YYYY-MM-DD HH:MM')
+    return paths
 
-        
-        #----------------------------------------------------------------------
-        # Assign restart interval
-        #----------------------------------------------------------------------
-        
-        self.restart_interval = restart_interval
 
+def _make_config(start_time, end_time, restart_interval, \
+                 restart_path, parflow_path, clm_path, dump_interval, run_name):
 
-        #----------------------------------------------------------------------
-        # Check path inputs
-        #----------------------------------------------------------------------
+    if(not (isinstance(start_time, str) and isinstance(end_time, str))):
+        raise RuntimeError('Starting time and ending time must be '\
+        'individual strings formatted (UTC): YYYY-MM-DD HH:MM')
 
-        if(isinstance(restart_path, str)):
-            if(glob(restart_path)):
-                self.restart_path = restart_path
+    if(restart_interval % dump_interval != 0):
+        raise RuntimeError('restart_interval (hours) must be a multiple of '\
+        'dump_interval (hours)')
 
-            else: 
-                os.makedirs(restart_path)
-                self.restart_path = restart_path
+    _check_paths(restart_path = restart_path, parflow_path = parflow_path, \
+                 clm_path = clm_path)
 
-        else: 
-            raise RuntimeError('restart_path must be a string')
+    if(run_name is not None and not isinstance(run_name, str)):
+        raise RuntimeError('run_name must be a string')
 
-        if(isinstance(parflow_path, str)):
-            if(glob(parflow_path)):
-                self.parflow_path = parflow_path
+    paths = _validate_paths(restart_path, parflow_path, clm_path)
+    if(not all(map(os.path.isdir, paths))):
+        _validate_paths.cache_clear()
+        paths = _validate_paths(restart_path, parflow_path, clm_path)
 
-            else: 
-                os.makedirs(parflow_path)
-                self.parflow_path = parflow_path
+    restart_path, parflow_path, clm_path = paths
 
-        else: 
-            raise RuntimeError('parflow_path must be a string')
-        
-        if(isinstance(clm_path, str)):
-            if(glob(clm_path)):
-                self.clm_path = clm_path
+    return RestartConfig(_parse_time(start_time), _parse_time(end_time), \
+        restart_interval, dump_interval, restart_path, parflow_path, clm_path, \
+        os.path.join(restart_path, 'clm-restart-log.csv'), \
+        os.path.join(restart_path, 'last_step.json'), run_name)
 
-            else: 
-                os.makedirs(clm_path)
-                self.clm_path = clm_path
 
-        else: 
-            raise RuntimeError('clm_path must be a string')
+#------------------------------------------------------------------------------
+# Read the last logged step from the tail of the log, not the whole file
+#------------------------------------------------------------------------------
+
+def _last_logged_step(log_path):
+
+    with open(log_path, 'rb') as f:
+        step_column = f.readline().strip().split(b',').index(b'parflow_step')
+
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - 4096))
+        last_line = [line for line in f.read().splitlines() if line.strip()][-1]
+
+    return int(last_line.split(b',')[step_column])
+
+
+#------------------------------------------------------------------------------
+# Restart: checks for log, copies restart files, updates log etc.
+#------------------------------------------------------------------------------
+
+def _prepare_restart(cfg):
+
+    wallclock = datetime.now().isoformat(sep = ' ', timespec = 'minutes')
+    timestamp = time.time()
+    last_timestamp = 0.0
+
+    if(os.path.isfile(cfg.last_step_path)):
+        with open(cfg.last_step_path) as f:
+            record = json.load(f)
+        old_step = record['parflow_step']
+        last_timestamp = record.get('timestamp', 0.0)
+
+    elif(os.path.isfile(cfg.restart_log_path)):
+        old_step = _last_logged_step(cfg.restart_log_path)
+
+    else:
+        old_step = None
+
+    copies = []
+
+    if(old_step is not None):
+        parflow_step = old_step + cfg.restart_interval // cfg.dump_interval
+
+        i = f'{parflow_step:05d}'
+        prefix = '' if cfg.run_name is None else cfg.run_name + PRESS_INFIX
+        source = _first_match(cfg.parflow_path, prefix, PRESS_INFIX + i + PFB_SUFFIX)
+        if(source is None):
+            raise RuntimeError('no pressure file for step ' + i + ' in ' + \
+                               cfg.parflow_path)
+
+        if(not _is_complete_pfb(source)):
+            raise RuntimeError(source + ' is not a complete PFB file')
+
+        destination = os.path.join(cfg.restart_path, 'rst.press.' + i + PFB_SUFFIX)
+        copies.append((source, destination))
+
+    else:
+        parflow_step = 0
 
 
     #--------------------------------------------------------------------------
-    # Restart method: checks for log, cropies restart files, updates log etc.
+    # copy restart files for posterity; skip those unchanged since the last
+    # restart (DirEntry.stat reuses what scandir already fetched)
     #--------------------------------------------------------------------------
 
-    def PrepareRestart(self):
+    with os.scandir(cfg.clm_path) as entries:
+        for entry in entries:
+            if(entry.name.startswith(CLM_RESTART_PREFIX) and \
+               entry.stat(follow_symlinks = False).st_mtime > last_timestamp):
+                copies.append((entry.path, \
+                    os.path.join(cfg.restart_path, entry.name)))
 
-        if(glob(self.restart_path+'/clm-restart-log.csv')):
-           dataframe = pd.read_csv(self.restart_path+'/clm-restart-log.csv')
-           old_step = np.copy(dataframe['parflow_step'][-1])
-           parflow_step = np.copy(old_step) + self.restart_interval
-           
-           i = f'{parflow_step:{'0'}{5}}'
-           if(glob(self.parflow_path + '/*out.press.i.pfb' )):
-               
-               source = glob.glob(self.parflow_path + '/*out.press.i.pfb')
-               destination = glob.glob(self.restart_path + '/rst.press.i.pfb')
-               os.shutil.copyfile(source, destination)
+    _copy_many(copies)
 
 
+    #--------------------------------------------------------------------------
+    # append to the log; replace the last-step record atomically
+    #--------------------------------------------------------------------------
+
+    new_log = not os.path.isfile(cfg.restart_log_path)
+    with open(cfg.restart_log_path, 'a') as f:
+        if(new_log):
+            f.write('parflow_step,wallclock\n')
+        f.write(f'{parflow_step},{wallclock}\n')
+
+    with open(cfg.last_step_path + '.tmp', 'w') as f:
+        json.dump({'parflow_step': parflow_step, 'wallclock': wallclock, \
+                   'timestamp': timestamp}, f)
+    os.replace(cfg.last_step_path + '.tmp', cfg.last_step_path)
 
-        else:
-            dataframe = pd.DataFrame()
-            first_step = True
-            wallclock = datetime.now().strftime("%Y-%m-%D %H:%M")
-            parflow_step = 0
+    return parflow_step
 
 
-        #----------------------------------------------------------------------
-        # copy restart files for posterity
-        #----------------------------------------------------------------------
+#------------------------------------------------------------------------------
+# Function interface for wrappers that restart in a loop
+#------------------------------------------------------------------------------
+
+def prepare_restart(start_time, end_time, \
+    restart_interval = 2190, \
+    restart_path = '../restart-files/', \
+    parflow_path = '../pf-output/', \
+    clm_path = '../clm-output/', \
+    dump_interval = 1, \
+    run_name = None):
 
+    return _prepare_restart(_make_config(start_time, end_time, \
+        restart_interval, restart_path, parflow_path, clm_path, dump_interval, \
+        run_name))
 
+
+#------------------------------------------------------------------------------
+# Create an object for all intents and purposes; some evil, some good 
+#------------------------------------------------------------------------------
+
+class RestartObject:
+
+    __slots__ = ('start', 'end', 'restart_interval', 'dump_interval', \
+                 'restart_path', 'parflow_path', 'clm_path', \
+                 'restart_log_path', 'last_step_path', 'run_name', '_config', \
+                 '_ticks')
+
+    def __init__(self, \
+        start_time, end_time, \
+        restart_interval = 2190, \
+        restart_path = '../restart-files/', \
+        parflow_path = '../pf-output/', \
+        clm_path = '../clm-output/', \
+        dump_interval = 1, \
+        run_name = None):
+
+        self._config = _make_config(start_time, end_time, restart_interval, \
+            restart_path, parflow_path, clm_path, dump_interval, run_name)
+        self._ticks = None
+
+        for name, value in zip(RestartConfig._fields, self._config):
+            setattr(self, name, value)
+
+
+    #--------------------------------------------------------------------------
+    # Model times (UTC) at which each restart interval begins (restart_interval
+    # is in hours, whatever the dump interval)
+    #--------------------------------------------------------------------------
+
+    def RestartTimes(self):
+
+        if(self._ticks is None):
+            import numpy as np
+            self._ticks = np.arange(np.datetime64(self.start, 's'), \
+                                    np.datetime64(self.end, 's'), \
+                                    np.timedelta64(self.restart_interval, 'h'))
+
+        return self._ticks
+
+
+    #--------------------------------------------------------------------------
+    # Restart method: see _prepare_restart
+    #--------------------------------------------------------------------------
+
+    def PrepareRestart(self):
+        return _prepare_restart(self._config)
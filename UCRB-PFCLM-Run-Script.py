@@ -74,12 +74,17 @@ Jackson Swilley | Feb 28, 2022 | js2834@princeton.edu or jackson.swilley5@gmail.
 
 import sys
 import os
-import numpy as np
-from datetime import datetime
+import fcntl
+import glob
+import json
+import struct
+import shutil
 from parflow.tools import Run
 from parflow.tools.fs import mkdir, cp, get_absolute_path, exists
 from parflow.tools.settings import set_working_directory
-import shutil
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import reduce
 
 
 #-----------------------------------------------------------------------------------------
@@ -88,7 +93,7 @@ import shutil
 
 run_name               = 'UCRB-run-001'
 
-script_path            = get_absolute_path('.') + '/'
+script_path            = get_absolute_path('.')
 input_path             = '../inputs/'
 forcing_path           = '../forcing'
 clm_output_path        = '../clm-output/'
@@ -103,9 +108,25 @@ slope_x_file           = 'UCRB.final.slope_x.pfb'
 slope_y_file           = 'UCRB.final.slope_y.pfb'
 flow_barrier_file      = 'UCRB.final.flow_barrier.pfb'
 initial_file           = 'UCRB-run-001.initial_press.pfb'
+clm_vegm_file          = None      # e.g. 'UCRB.final.drv_vegm.dat', linked in as drv_vegm.dat
 
 start_time             = 0
 stop_time              = 8760
+dump_interval          = None      # hours between pressure dumps, by output_mode if None
+time_step              = 1.0       # hours; must divide the hourly forcing (1.0, 0.5, 0.25, ...)
+
+nproc                  = 256
+mask_file              = None      # mask PFB (e.g. a run's .out.mask.pfb) to balance P x Q on
+
+output_mode            = 'debug'   # 'production', 'checkpoint' or 'debug'; see Output files
+netcdf_output          = False     # needs ParFlow built with parallel NetCDF (HDF5)
+distribute_forcing     = False     # dist the NLDAS forcing in place, once per topology
+
+parameter_file         = None      # YAML of ParFlow keys applied over the values below
+validate_keys          = True      # False skips pftools key validation at run time
+mpi_async_progress     = False     # MPICH progress thread, overlaps Allreduce with compute
+realizations           = []        # key overrides per sample, e.g. [{'Geom.s1.Perm.Value': 0.3}]
+parallel_realizations  = 1         # samples run at once, each on its own nproc ranks
 
 
 #-----------------------------------------------------------------------------------------
@@ -122,14 +143,36 @@ model.FileVersion = 4
 
 set_working_directory( pf_output_path )
 
-cp( input_path + domain_file )
-cp( input_path + subsurface_file )
-cp( input_path + flow_barrier_file )
-cp( input_path + slope_x_file )
-cp( input_path + slope_y_file )
-cp( input_path + initial_file )
-cp( input_path + mannings_file )
-cp( script_path + pf_run_file )
+input_abs_path     = get_absolute_path(input_path)
+output_abs_path    = get_absolute_path('.')
+
+# ParFlow only reads the domain solid file and CLM only reads the (41 MB) vegetation
+# map, so they are hard linked (or symlinked) rather than copied; the PFB inputs are
+# copied because model.dist rewrites them in place
+
+def link_or_copy(source, file_name = None):
+    destination = os.path.join(output_abs_path, file_name or os.path.basename(source))
+    if os.path.exists(destination) and os.path.samefile(source, destination):
+        return
+    if os.path.lexists(destination):
+        os.remove(destination)
+
+    try:
+        os.link(source, destination)
+    except OSError:
+        try:
+            os.symlink(source, destination)
+        except OSError:
+            cp( source, destination )
+
+staging    = [(link_or_copy, os.path.join(input_abs_path, domain_file)), \
+              (cp, os.path.join(script_path, pf_run_file))]
+
+if clm_vegm_file is not None:
+    staging.append((link_or_copy, os.path.join(input_abs_path, clm_vegm_file), 'drv_vegm.dat'))
+
+with ThreadPoolExecutor(max_workers = len(staging)) as executor:
+    list(executor.map(lambda job: job[0](*job[1:]), staging))
 
 
 #-----------------------------------------------------------------------------------------
@@ -139,44 +182,176 @@ cp( script_path + pf_run_file )
 istep      = start_time
 clmstep    = start_time
 
+# 'checkpoint' output dumps pressure about once a month, the other modes every hour
+
+if dump_interval is None:
+    dump_interval = 730 if output_mode == 'checkpoint' else 1
+
 model.TimingInfo.BaseUnit        = 1.0
-model.TimingInfo.DumpInterval    = 1.0
+model.TimingInfo.DumpInterval    = float(dump_interval)
 model.TimingInfo.StartCount      = start_time
 model.TimingInfo.StartTime       = start_time
 model.TimingInfo.StopTime        = stop_time
 
 model.TimeStep.Type     = 'Constant'
-model.TimeStep.Value    =  1.0
+model.TimeStep.Value    = time_step
 
+# CLM is called once per hourly forcing step and its fluxes reused for the ParFlow
+# timesteps in between
 
-#-----------------------------------------------------------------------------------------
-# Set processor topology
-#-----------------------------------------------------------------------------------------
+forcing_interval        = 1.0
+clm_reuse_count         = round(forcing_interval / time_step)
 
-model.Process.Topology.P    = 16
-model.Process.Topology.Q    = 16
-model.Process.Topology.R    = 1
-
-nproc = model.Process.Topology.P * model.Process.Topology.Q * model.Process.Topology.R
+if abs(clm_reuse_count * time_step - forcing_interval) > 1e-9:
+    raise RuntimeError('time_step must divide the forcing interval (1 hour)')
 
 
 #-----------------------------------------------------------------------------------------
 # Computational grid
 #-----------------------------------------------------------------------------------------
 
+# dz_scale (bottom layer first) sets both NZ and the variable dz below; layer
+# thickness = DZ * dz_scale
+
+dz_scale    = (1.0, 0.5, 0.25, 0.125, 0.050, 0.025, 0.005, 0.003, 0.0015, 0.0005)
+
 model.ComputationalGrid.Lower.X    = 0.0
 model.ComputationalGrid.Lower.Y    = 0.0
 model.ComputationalGrid.Lower.Z    = 0.0
 
 model.ComputationalGrid.NX    = 608
 model.ComputationalGrid.NY    = 896
-model.ComputationalGrid.NZ    = 10   
+model.ComputationalGrid.NZ    = len(dz_scale)
 
 model.ComputationalGrid.DX    = 1000.0
 model.ComputationalGrid.DY    = 1000.0
 model.ComputationalGrid.DZ    = 200.0
 
 
+#-----------------------------------------------------------------------------------------
+# Set processor topology
+#-----------------------------------------------------------------------------------------
+
+# ParFlow splits NX into P and NY into Q near-equal strips (the first NX % P get one
+# extra cell), so inactive cells of the basin mask can leave some ranks with little
+# work. Given mask_file, pick the P x Q = nproc split whose busiest rank has the least
+# active cells plus halo cells to exchange. Without one, split nproc by its prime
+# factors (largest first), each time across the currently longest tile side, so the
+# tiles stay close to square. CLM needs R = 1. The split is saved in topology_file on
+# the first run and reused after that: CLM writes its restart files per rank, so a
+# restart must keep the tiles they were written for.
+
+def dims_create(nproc, box):
+    box        = list(box)
+    dims       = [1] * len(box)
+    factors    = []
+    n, f       = nproc, 2
+
+    while n > 1:
+        while n % f == 0:
+            factors.append(f)
+            n //= f
+        f += 1
+
+    for f in sorted(factors, reverse = True):
+        i          = box.index(max(box))
+        box[i]    /= f
+        dims[i]   *= f
+
+    return dims
+
+def choose_topology(nproc, mask_file):
+    import numpy as np
+    from parflow.tools.io import read_pfb
+
+    mask      = read_pfb(get_absolute_path(mask_file)) > 0
+    nz        = mask.shape[0]
+    active    = mask.sum(axis = 0)
+    ny, nx    = active.shape
+    best      = None
+
+    for p in range(1, nproc + 1):
+        q = nproc // p
+        if nproc % p or p > nx or q > ny:
+            continue
+
+        x_starts    = np.cumsum([0] + [nx // p + (i < nx % p) for i in range(p - 1)])
+        y_starts    = np.cumsum([0] + [ny // q + (j < ny % q) for j in range(q - 1)])
+        tiles       = np.add.reduceat(np.add.reduceat(active, y_starts, axis = 0), x_starts, axis = 1)
+        halo        = 2 * nz * (-(-nx // p) - (-ny // q))
+        score       = tiles.max() + halo
+
+        if best is None or score < best[0]:
+            best = (score, p, q)
+
+    return best[1], best[2]
+
+topology_file = os.path.join(output_abs_path, run_name + '.topology.json')
+
+if os.path.isfile(topology_file):
+    with open(topology_file) as f:
+        P, Q = json.load(f)
+    if P * Q != nproc:
+        raise RuntimeError(run_name + ' was run on a ' + str(P) + ' x ' + str(Q) + \
+                           ' topology; remove ' + topology_file + ' to change nproc')
+else:
+    if mask_file is None:
+        P, Q = dims_create(nproc, [model.ComputationalGrid.NX, model.ComputationalGrid.NY])
+    else:
+        P, Q = choose_topology(nproc, mask_file)
+    with open(topology_file, 'w') as f:
+        json.dump([P, Q], f)
+
+model.Process.Topology.P    = P
+model.Process.Topology.Q    = Q
+
+model.Process.Topology.R    = 1
+
+
+#-----------------------------------------------------------------------------------------
+# Subsurface units: indicator value in subsurface_file, permeability (m/hr), porosity,
+# van Genuchten parameters and the vertical permeability tensor (TensorValZ) of
+# anisotropic units
+#-----------------------------------------------------------------------------------------
+
+units = [
+    {'name': 'domain',                  'perm': 0.02,        'porosity': 0.33,  'alpha': 0.5,   'n': 2.5,   'sres': 0.00001, 'tensor_z': 1.0},
+    {'name': 's1',     'indicator': 1,  'perm': 0.269022595, 'porosity': 0.375, 'alpha': 3.548, 'n': 4.162, 'sres': 0.0001},
+    {'name': 's2',     'indicator': 2,  'perm': 0.043630356, 'porosity': 0.39,  'alpha': 3.467, 'n': 2.738, 'sres': 0.0001},
+    {'name': 's3',     'indicator': 3,  'perm': 0.015841225, 'porosity': 0.387, 'alpha': 2.692, 'n': 2.445, 'sres': 0.0001},
+    {'name': 's4',     'indicator': 4,  'perm': 0.007582087, 'porosity': 0.439, 'alpha': 0.501, 'n': 2.659, 'sres': 0.1},
+    {'name': 's5',     'indicator': 5,  'perm': 0.01818816,  'porosity': 0.489, 'alpha': 0.661, 'n': 2.659, 'sres': 0.0001},
+    {'name': 's6',     'indicator': 6,  'perm': 0.005009435, 'porosity': 0.399, 'alpha': 1.122, 'n': 2.479, 'sres': 0.0001},
+    {'name': 's7',     'indicator': 7,  'perm': 0.005492736, 'porosity': 0.384, 'alpha': 2.089, 'n': 2.318, 'sres': 0.0001},
+    {'name': 's8',     'indicator': 8,  'perm': 0.004675077, 'porosity': 0.482, 'alpha': 0.832, 'n': 2.514, 'sres': 0.0001},
+    {'name': 's9',     'indicator': 9,  'perm': 0.003386794, 'porosity': 0.442, 'alpha': 1.585, 'n': 2.413, 'sres': 0.0001},
+    {'name': 's10',    'indicator': 10, 'perm': 0.004783973, 'porosity': 0.385, 'alpha': 3.311, 'n': 2.202, 'sres': 0.0001},
+    {'name': 's11',    'indicator': 11, 'perm': 0.003979136, 'porosity': 0.481, 'alpha': 1.622, 'n': 2.318, 'sres': 0.0001},
+    {'name': 's12',    'indicator': 12, 'perm': 0.006162952, 'porosity': 0.459, 'alpha': 1.514, 'n': 2.259, 'sres': 0.0001},
+    {'name': 's13',    'indicator': 13, 'perm': 0.005009435, 'porosity': 0.399, 'alpha': 1.122, 'n': 2.479, 'sres': 0.0001},
+    {'name': 'g1',     'indicator': 21, 'perm': 0.02,        'porosity': 0.33,                                               'tensor_z': 0.1},
+    {'name': 'g2',     'indicator': 22, 'perm': 0.03,        'porosity': 0.33,                                               'tensor_z': 0.1},
+    {'name': 'g3',     'indicator': 23, 'perm': 0.04,        'porosity': 0.33},
+    {'name': 'g4',     'indicator': 24, 'perm': 0.05,        'porosity': 0.33,                                               'tensor_z': 0.1},
+    {'name': 'g5',     'indicator': 25, 'perm': 0.06,        'porosity': 0.33,                                               'tensor_z': 0.1},
+    {'name': 'g6',     'indicator': 26, 'perm': 0.08,        'porosity': 0.33,                                               'tensor_z': 0.1},
+    {'name': 'g7',     'indicator': 27, 'perm': 0.1,         'porosity': 0.33,                                               'tensor_z': 0.1},
+    {'name': 'g8',     'indicator': 28, 'perm': 0.2,         'porosity': 0.33},
+    {'name': 'b1',     'indicator': 19, 'perm': 0.005,                                                                       'tensor_z': 0.1},
+    {'name': 'b2',     'indicator': 20, 'perm': 0.01,                                                                        'tensor_z': 0.1},
+]
+
+unit_names            = [u['name'] for u in units]
+
+if len(set(unit_names)) != len(unit_names) or any('perm' not in u for u in units):
+    raise RuntimeError('each unit needs a unique name and a perm value')
+
+indicator_units       = [u for u in units if 'indicator' in u]
+porosity_units        = [u for u in units if 'porosity' in u]
+vangenuchten_units    = [u for u in units if 'alpha' in u]
+tensor_units          = [u for u in units if 'tensor_z' in u]
+
+
 #-----------------------------------------------------------------------------------------
 # Name GeomInputs
 #-----------------------------------------------------------------------------------------
@@ -194,133 +369,39 @@ model.Geom.domain.Patches                = 'top bottom land'
 #-----------------------------------------------------------------------------------------
 
 model.GeomInput.indi_input.InputType    = 'IndicatorField'
-model.GeomInput.indi_input.GeomNames    = 's1 s2 s3 s4 s5 s6 s7 s8 s9 s10 s11 s12 s13 g1 g2 g3 g4 g5 g6 g7 g8 b1 b2'
+model.GeomInput.indi_input.GeomNames    = ' '.join(u['name'] for u in indicator_units)
 model.Geom.indi_input.FileName          = subsurface_file
-model.dist(subsurface_file)
-
-model.GeomInput.s1.Value     = 1
-model.GeomInput.s2.Value     = 2
-model.GeomInput.s3.Value     = 3
-model.GeomInput.s4.Value     = 4
-model.GeomInput.s5.Value     = 5
-model.GeomInput.s6.Value     = 6
-model.GeomInput.s7.Value     = 7
-model.GeomInput.s8.Value     = 8
-model.GeomInput.s9.Value     = 9
-model.GeomInput.s10.Value    = 10
-model.GeomInput.s11.Value    = 11
-model.GeomInput.s12.Value    = 12
-model.GeomInput.s13.Value    = 13
-model.GeomInput.g1.Value     = 21
-model.GeomInput.g2.Value     = 22
-model.GeomInput.g3.Value     = 23
-model.GeomInput.g4.Value     = 24
-model.GeomInput.g5.Value     = 25
-model.GeomInput.g6.Value     = 26
-model.GeomInput.g7.Value     = 27
-model.GeomInput.g8.Value     = 28
-model.GeomInput.b1.Value     = 19
-model.GeomInput.b2.Value     = 20
-
-
-#-----------------------------------------------------------------------------------------
-# variable dz assignments
+
+for u in indicator_units:
+    getattr(model.GeomInput, u['name']).Value = u['indicator']
+
+
+#-----------------------------------------------------------------------------------------
+# variable dz assignments from dz_scale (see Computational grid)
 #-----------------------------------------------------------------------------------------
 
 model.Solver.Nonlinear.VariableDz    = True 
 model.dzScale.GeomNames              = 'domain'
 model.dzScale.Type                   = 'nzList'
-model.dzScale.nzListNumber           = 10
+model.dzScale.nzListNumber           = len(dz_scale)
+
+if min(dz_scale) <= 0:
+    raise RuntimeError('dz_scale values must be positive')
 
-model.Cell._0.dzScale.Value    = 1.0
-model.Cell._1.dzScale.Value    = 0.5
-model.Cell._2.dzScale.Value    = 0.25
-model.Cell._3.dzScale.Value    = 0.125
-model.Cell._4.dzScale.Value    = 0.050
-model.Cell._5.dzScale.Value    = 0.025
-model.Cell._6.dzScale.Value    = 0.005
-model.Cell._7.dzScale.Value    = 0.003
-model.Cell._8.dzScale.Value    = 0.0015
-model.Cell._9.dzScale.Value    = 0.0005
+for i, value in enumerate(dz_scale):
+    getattr(model.Cell, f'_{i}').dzScale.Value = value
 
 
 #-----------------------------------------------------------------------------------------
 # Permeability (values in m/hr)
 #-----------------------------------------------------------------------------------------
 
-model.Geom.Perm.Names           = 'domain s1 s2 s3 s4 s5 s6 s7 s8 s9 s10 s11 s12 s13 g1 g2 g3 g4 g5 g6 g7 g8 b1 b2'
-
-model.Geom.domain.Perm.Type     = 'Constant'
-model.Geom.domain.Perm.Value    = 0.02
-
-model.Geom.s1.Perm.Type         = 'Constant'
-model.Geom.s1.Perm.Value        = 0.269022595
+model.Geom.Perm.Names    = ' '.join(unit_names)
 
-model.Geom.s2.Perm.Type         = 'Constant'
-model.Geom.s2.Perm.Value        = 0.043630356
-
-model.Geom.s3.Perm.Type         = 'Constant'
-model.Geom.s3.Perm.Value        = 0.015841225
-
-model.Geom.s4.Perm.Type         = 'Constant'
-model.Geom.s4.Perm.Value        = 0.007582087
-
-model.Geom.s5.Perm.Type         = 'Constant'
-model.Geom.s5.Perm.Value        = 0.01818816
-
-model.Geom.s6.Perm.Type         = 'Constant'
-model.Geom.s6.Perm.Value        = 0.005009435
-
-model.Geom.s7.Perm.Type         = 'Constant'
-model.Geom.s7.Perm.Value        = 0.005492736
-
-model.Geom.s8.Perm.Type         = 'Constant'
-model.Geom.s8.Perm.Value        = 0.004675077
-
-model.Geom.s9.Perm.Type         = 'Constant'
-model.Geom.s9.Perm.Value        = 0.003386794
-
-model.Geom.s10.Perm.Type        = 'Constant'
-model.Geom.s10.Perm.Value       = 0.004783973
-
-model.Geom.s11.Perm.Type        = 'Constant'
-model.Geom.s11.Perm.Value       = 0.003979136
-
-model.Geom.s12.Perm.Type        = 'Constant'
-model.Geom.s12.Perm.Value       = 0.006162952
-
-model.Geom.s13.Perm.Type        = 'Constant'
-model.Geom.s13.Perm.Value       = 0.005009435
-
-model.Geom.b1.Perm.Type         = 'Constant'
-model.Geom.b1.Perm.Value        = 0.005
-
-model.Geom.b2.Perm.Type         = 'Constant'
-model.Geom.b2.Perm.Value        = 0.01
-
-model.Geom.g1.Perm.Type         = 'Constant'
-model.Geom.g1.Perm.Value        = 0.02
-
-model.Geom.g2.Perm.Type         = 'Constant'
-model.Geom.g2.Perm.Value        = 0.03
-
-model.Geom.g3.Perm.Type         = 'Constant'
-model.Geom.g3.Perm.Value        = 0.04
-
-model.Geom.g4.Perm.Type         = 'Constant'
-model.Geom.g4.Perm.Value        = 0.05
-
-model.Geom.g5.Perm.Type         = 'Constant'
-model.Geom.g5.Perm.Value        = 0.06
-
-model.Geom.g6.Perm.Type         = 'Constant'
-model.Geom.g6.Perm.Value        = 0.08
-
-model.Geom.g7.Perm.Type         = 'Constant'
-model.Geom.g7.Perm.Value        = 0.1
-
-model.Geom.g8.Perm.Type         = 'Constant'
-model.Geom.g8.Perm.Value        = 0.2
+for u in units:
+    perm          = getattr(model.Geom, u['name']).Perm
+    perm.Type     = 'Constant'
+    perm.Value    = u['perm']
 
 
 #-----------------------------------------------------------------------------------------
@@ -328,43 +409,13 @@ model.Geom.g8.Perm.Value        = 0.2
 #-----------------------------------------------------------------------------------------
 
 model.Perm.TensorType                 = 'TensorByGeom'
-model.Geom.Perm.TensorByGeom.Names    = 'domain b1 b2 g1 g2 g4 g5 g6 g7'
-
-model.Geom.domain.Perm.TensorValX     = 1.0
-model.Geom.domain.Perm.TensorValY     = 1.0
-model.Geom.domain.Perm.TensorValZ     = 1.0
+model.Geom.Perm.TensorByGeom.Names    = ' '.join(u['name'] for u in tensor_units)
 
-model.Geom.b1.Perm.TensorValX         = 1.0
-model.Geom.b1.Perm.TensorValY         = 1.0
-model.Geom.b1.Perm.TensorValZ         = 0.1
-
-model.Geom.b2.Perm.TensorValX         = 1.0
-model.Geom.b2.Perm.TensorValY         = 1.0
-model.Geom.b2.Perm.TensorValZ         = 0.1
-
-model.Geom.g1.Perm.TensorValX         = 1.0
-model.Geom.g1.Perm.TensorValY         = 1.0
-model.Geom.g1.Perm.TensorValZ         = 0.1
-
-model.Geom.g2.Perm.TensorValX         = 1.0
-model.Geom.g2.Perm.TensorValY         = 1.0
-model.Geom.g2.Perm.TensorValZ         = 0.1
-
-model.Geom.g4.Perm.TensorValX         = 1.0
-model.Geom.g4.Perm.TensorValY         = 1.0
-model.Geom.g4.Perm.TensorValZ         = 0.1
-
-model.Geom.g5.Perm.TensorValX         = 1.0
-model.Geom.g5.Perm.TensorValY         = 1.0
-model.Geom.g5.Perm.TensorValZ         = 0.1
-
-model.Geom.g6.Perm.TensorValX         = 1.0
-model.Geom.g6.Perm.TensorValY         = 1.0
-model.Geom.g6.Perm.TensorValZ         = 0.1
-
-model.Geom.g7.Perm.TensorValX         = 1.0
-model.Geom.g7.Perm.TensorValY         = 1.0
-model.Geom.g7.Perm.TensorValZ         = 0.1
+for u in tensor_units:
+    tensor               = getattr(model.Geom, u['name']).Perm
+    tensor.TensorValX    = 1.0
+    tensor.TensorValY    = 1.0
+    tensor.TensorValZ    = u['tensor_z']
 
 
 #-----------------------------------------------------------------------------------------
@@ -374,250 +425,48 @@ model.Geom.g7.Perm.TensorValZ         = 0.1
 model.Solver.Nonlinear.FlowBarrierZ    = True
 model.FBz.Type                         = 'PFBFile'
 model.Geom.domain.FBz.FileName         = flow_barrier_file
-model.dist(flow_barrier_file)
 
 
 #-----------------------------------------------------------------------------------------
 # Porosity
 #-----------------------------------------------------------------------------------------
 
-model.Geom.Porosity.GeomNames       = "domain s1 s2 s3 s4 s5 s6 s7 s8 s9 s10 s11 s12 s13 g1 g2 g3 g4 g5 g6 g7 g8"
-
-model.Geom.domain.Porosity.Type     = 'Constant'
-model.Geom.domain.Porosity.Value    = 0.33
-
-model.Geom.s1.Porosity.Type         = 'Constant'
-model.Geom.s1.Porosity.Value        = 0.375
-
-model.Geom.s2.Porosity.Type         = 'Constant'
-model.Geom.s2.Porosity.Value        = 0.39
-
-model.Geom.s3.Porosity.Type         = 'Constant'
-model.Geom.s3.Porosity.Value        = 0.387
-
-model.Geom.s4.Porosity.Type         = 'Constant'
-model.Geom.s4.Porosity.Value        = 0.439
-
-model.Geom.s5.Porosity.Type         = 'Constant'
-model.Geom.s5.Porosity.Value        = 0.489
-
-model.Geom.s6.Porosity.Type         = 'Constant'
-model.Geom.s6.Porosity.Value        = 0.399
-
-model.Geom.s7.Porosity.Type         = 'Constant'
-model.Geom.s7.Porosity.Value        = 0.384
-
-model.Geom.s8.Porosity.Type         = 'Constant'
-model.Geom.s8.Porosity.Value        = 0.482
-
-model.Geom.s9.Porosity.Type         = 'Constant'
-model.Geom.s9.Porosity.Value        = 0.442
-
-model.Geom.s10.Porosity.Type        = 'Constant'
-model.Geom.s10.Porosity.Value       = 0.385
-
-model.Geom.s11.Porosity.Type        = 'Constant'
-model.Geom.s11.Porosity.Value       = 0.481
-
-model.Geom.s12.Porosity.Type        = 'Constant'
-model.Geom.s12.Porosity.Value       = 0.459
-
-model.Geom.s13.Porosity.Type        = 'Constant'
-model.Geom.s13.Porosity.Value       = 0.399
+model.Geom.Porosity.GeomNames    = ' '.join(u['name'] for u in porosity_units)
 
-model.Geom.g1.Porosity.Type         = 'Constant'
-model.Geom.g1.Porosity.Value        = 0.33
-
-model.Geom.g2.Porosity.Type         = 'Constant'
-model.Geom.g2.Porosity.Value        = 0.33
-
-model.Geom.g3.Porosity.Type         = 'Constant'
-model.Geom.g3.Porosity.Value        = 0.33
-
-model.Geom.g4.Porosity.Type         = 'Constant'
-model.Geom.g4.Porosity.Value        = 0.33
-
-model.Geom.g5.Porosity.Type         = 'Constant'
-model.Geom.g5.Porosity.Value        =  0.33
-
-model.Geom.g6.Porosity.Type         = 'Constant'
-model.Geom.g6.Porosity.Value        = 0.33
-
-model.Geom.g7.Porosity.Type         = 'Constant'
-model.Geom.g7.Porosity.Value        = 0.33
-
-model.Geom.g8.Porosity.Type         = 'Constant'
-model.Geom.g8.Porosity.Value        = 0.33
+for u in porosity_units:
+    porosity          = getattr(model.Geom, u['name']).Porosity
+    porosity.Type     = 'Constant'
+    porosity.Value    = u['porosity']
 
 
 #-----------------------------------------------------------------------------------------
-# Relative permeability
+# Relative permeability and saturation (van Genuchten, same alpha and n per unit)
 #-----------------------------------------------------------------------------------------
 
-model.Phase.RelPerm.Type         = 'VanGenuchten'
-model.Phase.RelPerm.GeomNames    = "domain s1 s2 s3 s4 s5 s6 s7 s8 s9 s10 s11 s12 s13"
-
-model.Geom.domain.RelPerm.Alpha                  = 0.5
-model.Geom.domain.RelPerm.N                      = 2.5
-model.Geom.domain.RelPerm.NumSamplePoints        = 20000
-model.Geom.domain.RelPerm.MinPressureHead        = -300
-model.Geom.domain.RelPerm.InterpolationMethod    = 'Linear'
-
-model.Geom.s1.RelPerm.Alpha                      = 3.548
-model.Geom.s1.RelPerm.N                          = 4.162
-model.Geom.s1.RelPerm.NumSamplePoints            = 20000
-model.Geom.s1.RelPerm.MinPressureHead            = -300
-model.Geom.s1.RelPerm.InterpolationMethod        = 'Linear'
-
-model.Geom.s2.RelPerm.Alpha                      = 3.467
-model.Geom.s2.RelPerm.N                          = 2.738
-model.Geom.s2.RelPerm.NumSamplePoints            = 20000
-model.Geom.s2.RelPerm.MinPressureHead            = -300
-model.Geom.s2.RelPerm.InterpolationMethod        = 'Linear'
-
-model.Geom.s3.RelPerm.Alpha                      = 2.692
-model.Geom.s3.RelPerm.N                          = 2.445
-model.Geom.s3.RelPerm.NumSamplePoints            = 20000
-model.Geom.s3.RelPerm.MinPressureHead            = -300
-model.Geom.s3.RelPerm.InterpolationMethod        = 'Linear'
+# Kr is looked up from a table of NumSamplePoints per geom at every residual evaluation;
+# monotone spline interpolation keeps 2000 points as accurate as a much longer linear
+# table, and small enough to stay cache-resident (0 evaluates van Genuchten directly)
 
-model.Geom.s4.RelPerm.Alpha                      = 0.501
-model.Geom.s4.RelPerm.N                          = 2.659
-model.Geom.s4.RelPerm.NumSamplePoints            = 20000
-model.Geom.s4.RelPerm.MinPressureHead            = -300
-model.Geom.s4.RelPerm.InterpolationMethod        = 'Linear'
+relperm_sample_points               = 2000
+relperm_interpolation               = 'Spline'
+vangenuchten_names                  = ' '.join(u['name'] for u in vangenuchten_units)
 
-model.Geom.s5.RelPerm.Alpha                      = 0.661
-model.Geom.s5.RelPerm.N                          = 2.659
-model.Geom.s5.RelPerm.NumSamplePoints            = 20000
-model.Geom.s5.RelPerm.MinPressureHead            = -300
-model.Geom.s5.RelPerm.InterpolationMethod        = 'Linear'
+model.Phase.RelPerm.Type            = 'VanGenuchten'
+model.Phase.RelPerm.GeomNames       = vangenuchten_names
+model.Phase.Saturation.Type         = 'VanGenuchten'
+model.Phase.Saturation.GeomNames    = vangenuchten_names
 
-model.Geom.s6.RelPerm.Alpha                      = 1.122
-model.Geom.s6.RelPerm.N                          = 2.479
-model.Geom.s6.RelPerm.NumSamplePoints            = 20000
-model.Geom.s6.RelPerm.MinPressureHead            = -300
-model.Geom.s6.RelPerm.InterpolationMethod        = 'Linear'
-
-model.Geom.s7.RelPerm.Alpha                      = 2.089
-model.Geom.s7.RelPerm.N                          = 2.318
-model.Geom.s7.RelPerm.NumSamplePoints            = 20000
-model.Geom.s7.RelPerm.MinPressureHead            = -300
-model.Geom.s7.RelPerm.InterpolationMethod        = 'Linear'
-
-model.Geom.s8.RelPerm.Alpha                      = 0.832
-model.Geom.s8.RelPerm.N                          = 2.514
-model.Geom.s8.RelPerm.NumSamplePoints            = 20000
-model.Geom.s8.RelPerm.MinPressureHead            = -300
-model.Geom.s8.RelPerm.InterpolationMethod        = 'Linear'
-
-model.Geom.s9.RelPerm.Alpha                      = 1.585
-model.Geom.s9.RelPerm.N                          = 2.413
-model.Geom.s9.RelPerm.NumSamplePoints            = 20000
-model.Geom.s9.RelPerm.MinPressureHead            = -300
-model.Geom.s9.RelPerm.InterpolationMethod        = 'Linear'
-
-model.Geom.s10.RelPerm.Alpha                     = 3.311
-model.Geom.s10.RelPerm.N                         = 2.202
-model.Geom.s10.RelPerm.NumSamplePoints           = 20000
-model.Geom.s10.RelPerm.MinPressureHead           = -300
-model.Geom.s10.RelPerm.InterpolationMethod       = 'Linear'
-
-model.Geom.s11.RelPerm.Alpha                     = 1.622
-model.Geom.s11.RelPerm.N                         = 2.318
-model.Geom.s11.RelPerm.NumSamplePoints           = 20000
-model.Geom.s11.RelPerm.MinPressureHead           = -300
-model.Geom.s11.RelPerm.InterpolationMethod       = 'Linear'
-
-model.Geom.s12.RelPerm.Alpha                     = 1.514
-model.Geom.s12.RelPerm.N                         = 2.259
-model.Geom.s12.RelPerm.NumSamplePoints           = 20000
-model.Geom.s12.RelPerm.MinPressureHead           = -300
-model.Geom.s12.RelPerm.InterpolationMethod       = 'Linear'
-
-model.Geom.s13.RelPerm.Alpha                     = 1.122
-model.Geom.s13.RelPerm.N                         = 2.479
-model.Geom.s13.RelPerm.NumSamplePoints           = 20000
-model.Geom.s13.RelPerm.MinPressureHead           = -300
-model.Geom.s13.RelPerm.InterpolationMethod       = 'Linear'
-
-
-#-----------------------------------------------------------------------------------------
-# Saturation
-#-----------------------------------------------------------------------------------------
-
-model.Phase.Saturation.Type           = 'VanGenuchten'
-model.Phase.Saturation.GeomNames      = 'domain s1 s2 s3 s4 s5 s6 s7 s8 s9 s10 s11 s12 s13'
-
-model.Geom.domain.Saturation.Alpha    = 0.5
-model.Geom.domain.Saturation.N        = 2.5
-model.Geom.domain.Saturation.SRes     = 0.00001
-model.Geom.domain.Saturation.SSat     = 1.0
-
-model.Geom.s1.Saturation.Alpha        = 3.548
-model.Geom.s1.Saturation.N            = 4.162
-model.Geom.s1.Saturation.SRes         = 0.0001
-model.Geom.s1.Saturation.SSat         = 1.0
-
-model.Geom.s2.Saturation.Alpha        = 3.467
-model.Geom.s2.Saturation.N            = 2.738
-model.Geom.s2.Saturation.SRes         = 0.0001
-model.Geom.s2.Saturation.SSat         = 1.0
-
-model.Geom.s3.Saturation.Alpha        = 2.692
-model.Geom.s3.Saturation.N            = 2.445
-model.Geom.s3.Saturation.SRes         = 0.0001
-model.Geom.s3.Saturation.SSat         = 1.0
-
-model.Geom.s4.Saturation.Alpha        = 0.501
-model.Geom.s4.Saturation.N            = 2.659
-model.Geom.s4.Saturation.SRes         = 0.1
-model.Geom.s4.Saturation.SSat         = 1.0
-
-model.Geom.s5.Saturation.Alpha        = 0.661
-model.Geom.s5.Saturation.N            = 2.659
-model.Geom.s5.Saturation.SRes         = 0.0001
-model.Geom.s5.Saturation.SSat         = 1.0
-
-model.Geom.s6.Saturation.Alpha        = 1.122
-model.Geom.s6.Saturation.N            = 2.479
-model.Geom.s6.Saturation.SRes         = 0.0001
-model.Geom.s6.Saturation.SSat         = 1.0
-
-model.Geom.s7.Saturation.Alpha        = 2.089
-model.Geom.s7.Saturation.N            = 2.318
-model.Geom.s7.Saturation.SRes         = 0.0001
-model.Geom.s7.Saturation.SSat         = 1.0
-
-model.Geom.s8.Saturation.Alpha        = 0.832
-model.Geom.s8.Saturation.N            = 2.514
-model.Geom.s8.Saturation.SRes         = 0.0001
-model.Geom.s8.Saturation.SSat         = 1.0
-
-model.Geom.s9.Saturation.Alpha        = 1.585
-model.Geom.s9.Saturation.N            = 2.413
-model.Geom.s9.Saturation.SRes         = 0.0001
-model.Geom.s9.Saturation.SSat         = 1.0
-
-model.Geom.s10.Saturation.Alpha       = 3.311
-model.Geom.s10.Saturation.N           = 2.202
-model.Geom.s10.Saturation.SRes        = 0.0001
-model.Geom.s10.Saturation.SSat        = 1.0
-
-model.Geom.s11.Saturation.Alpha       = 1.622
-model.Geom.s11.Saturation.N           = 2.318
-model.Geom.s11.Saturation.SRes        = 0.0001
-model.Geom.s11.Saturation.SSat        = 1.0
-
-model.Geom.s12.Saturation.Alpha       = 1.514
-model.Geom.s12.Saturation.N           = 2.259
-model.Geom.s12.Saturation.SRes        = 0.0001
-model.Geom.s12.Saturation.SSat        = 1.0
-
-model.Geom.s13.Saturation.Alpha       = 1.122
-model.Geom.s13.Saturation.N           = 2.479
-model.Geom.s13.Saturation.SRes        = 0.0001
-model.Geom.s13.Saturation.SSat        = 1.0
+for u in vangenuchten_units:
+    geom                                = getattr(model.Geom, u['name'])
+    geom.RelPerm.Alpha                  = u['alpha']
+    geom.RelPerm.N                      = u['n']
+    geom.RelPerm.NumSamplePoints        = relperm_sample_points
+    geom.RelPerm.MinPressureHead        = -300
+    geom.RelPerm.InterpolationMethod    = relperm_interpolation
+    geom.Saturation.Alpha               = u['alpha']
+    geom.Saturation.N                   = u['n']
+    geom.Saturation.SRes                = u['sres']
+    geom.Saturation.SSat                = 1.0
 
 
 #-----------------------------------------------------------------------------------------
@@ -635,7 +484,6 @@ model.Geom.domain.SpecificStorage.Value    = 1.0e-4
 
 model.Mannings.Type        = 'PFBFile'
 model.Mannings.FileName    = mannings_file
-model.dist(mannings_file)
 
 
 #-----------------------------------------------------------------------------------------
@@ -732,7 +580,6 @@ model.Patch.land.BCPressure.alltime.Value      = 0.0
 model.TopoSlopesX.Type         = 'PFBFile'
 model.TopoSlopesX.GeomNames    = 'domain'
 model.TopoSlopesX.FileName     = slope_x_file
-model.dist(slope_x_file)
 
 
 #-----------------------------------------------------------------------------------------
@@ -742,7 +589,6 @@ model.dist(slope_x_file)
 model.TopoSlopesY.Type         = 'PFBFile'
 model.TopoSlopesY.GeomNames    = 'domain'
 model.TopoSlopesY.FileName     = slope_y_file
-model.dist(slope_y_file)
 
 
 #-----------------------------------------------------------------------------------------
@@ -755,7 +601,6 @@ model.Geom.domain.ICPressure.RefPatch    = 'bottom'
 model.ICPressure.Type                    = 'PFBFile'
 model.ICPressure.GeomNames               = 'domain'
 model.Geom.domain.ICPressure.FileName    = initial_file
-model.dist(initial_file)
 
 
 #-----------------------------------------------------------------------------------------
@@ -772,7 +617,7 @@ model.KnownSolution    = 'NoKnownSolution'
 model.Solver.LSM                    = 'CLM'
 model.Solver.CLM.CLMFileDir         = clm_output_path
 model.Solver.CLM.Print1dOut         = False
-model.Solver.CLM.CLMDumpInterval    = 1
+model.Solver.CLM.CLMDumpInterval    = 6
 model.Solver.CLM.MetForcing         = '3D'
 model.Solver.CLM.MetFileName        = 'NLDAS'
 model.Solver.CLM.MetFilePath        = forcing_path
@@ -786,7 +631,7 @@ model.Solver.CLM.FieldCapacity      = 1.00
 model.Solver.CLM.IrrigationType     = None
 model.Solver.CLM.RootZoneNZ         = 4
 model.Solver.CLM.SoiLayer           = 4
-model.Solver.CLM.ReuseCount         = 1 
+model.Solver.CLM.ReuseCount         = clm_reuse_count
 model.Solver.CLM.WriteLogs          = False
 model.Solver.CLM.WriteLastRST       = True
 model.Solver.CLM.DailyRST           = True
@@ -798,49 +643,294 @@ model.Solver.CLM.SingleFile         = True
 #-----------------------------------------------------------------------------------------
 
 model.Solver                                                = 'Richards'
-model.Solver.MaxIter                                        = 250000
-model.Solver.MaxConvergenceFailures                         = 5
+model.Solver.MaxIter                                        = 2 * int((stop_time - start_time) / model.TimeStep.Value)
+model.Solver.MaxConvergenceFailures                         = 8
 model.Solver.EvapTransFile                                  = False
 model.Solver.BinaryOutDir                                   = False
 model.Solver.TerrainFollowingGrid                           = True
 model.Solver.TerrainFollowingGrid.SlopeUpwindFormulation    = 'Upwind'
-model.Solver.Nonlinear.MaxIter                              = 250
+
+
+#-----------------------------------------------------------------------------------------
+# Nonlinear (Newton) solver; the Jacobian is assembled analytically, once per iteration.
+# The linear tolerance (eta) follows Eisenstat-Walker: loose while Newton is far from
+# converged, tight near the end, so GMRES does not oversolve early iterations
+# (Walker2: eta_k = EtaGamma * (||F_k|| / ||F_k-1||) ** EtaAlpha). DerivativeEpsilon is
+# only read for the finite-difference Jacobian (UseJacobian = False).
+#-----------------------------------------------------------------------------------------
+
+model.Solver.Nonlinear.MaxIter                              = 30
 model.Solver.Nonlinear.ResidualTol                          = 1e-2
-model.Solver.Nonlinear.EtaChoice                            = 'EtaConstant'
-model.Solver.Nonlinear.EtaValue                             = 1e-2 
+model.Solver.Nonlinear.EtaChoice                            = 'Walker2'
+model.Solver.Nonlinear.EtaAlpha                             = 2.0
+model.Solver.Nonlinear.EtaGamma                             = 0.9
 model.Solver.Nonlinear.UseJacobian                          = True
-model.Solver.Nonlinear.DerivativeEpsilon                    = 1e-16
-model.Solver.Nonlinear.StepTol                              = 1e-15
-model.Solver.Nonlinear.Globalization                        = 'LineSearch'
-model.Solver.Linear.KrylovDimension                         = 500
-model.Solver.Linear.MaxRestarts                             = 8
+model.Solver.Nonlinear.DerivativeEpsilon                    = 1e-8
+model.Solver.Nonlinear.StepTol                              = 1e-10
+model.Solver.Nonlinear.Globalization                        = 'InexactNewton'
+
+
+#-----------------------------------------------------------------------------------------
+# Linear (GMRES) solver and PFMG preconditioner. A short Krylov basis with more restarts
+# keeps the stored vectors and Gram-Schmidt work small; KrylovDimension = 500 was a
+# workaround for isolated hard timesteps and should not be the default. One red-black
+# Gauss-Seidel sweep before and after each coarsening keeps PFMG cheap; on a ParFlow
+# built with a CUDA accelerator backend and GPU hypre the same settings run on the GPU
+# (one rank per GPU).
+#-----------------------------------------------------------------------------------------
+
+model.Solver.Linear.KrylovDimension                         = 50
+model.Solver.Linear.MaxRestarts                             = 40
 model.Solver.Linear.Preconditioner                          = 'PFMG'
-model.Solver.Linear.Preconditioner.PCMatrixType             = 'PFSeymmetric'
-model.Solver.Linear.Preconditioner.PFMG.NumPreRelax         = 3
-model.Solver.Linear.Preconditioner.PFMG.NumPostRelax        = 2
-
-model.Solver.PrintPressure               = True
-model.Solver.PrintCLM                    = True
-model.Solver.PrintSaturation             = False
-model.Solver.PrintVelocities             = False
-model.Solver.PrintSubsurfData            = False
-model.Solver.PrintMask                   = False
-model.Solver.WriteCLMBinary              = False
-model.Solver.WriteSiloSpecificStorage    = False
-model.Solver.WriteSiloMannings           = False
-model.Solver.WriteSiloMask               = False
-model.Solver.WriteSiloSlopes             = False
-model.Solver.WriteSiloSubsurfData        = False
-model.Solver.WriteSiloSaturation         = False
-model.Solver.WriteSiloPressure           = False
-model.Solver.WriteSiloEvapTrans          = False
-model.Solver.WriteSiloEvapTransSum       = False
-model.Solver.WriteSiloOverlandSum        = False
-model.Solver.WriteSiloCLM                = False
-
-
-#-----------------------------------------------------------------------------------------
-# Run and Unload the ParFlow output files
-#-----------------------------------------------------------------------------------------
-
-model.run()
\ No newline at end of file
+model.Solver.Linear.Preconditioner.PCMatrixType             = 'PFSymmetric'
+model.Solver.Linear.Preconditioner.PFMG.Smoother            = 'RBGaussSeidelNonSymmetric'
+model.Solver.Linear.Preconditioner.PFMG.NumPreRelax         = 1
+model.Solver.Linear.Preconditioner.PFMG.NumPostRelax        = 1
+
+
+#-----------------------------------------------------------------------------------------
+# Output files. Every Print and WriteSilo key starts off and output_mode switches on
+# what a run needs: 'production' writes only the CLM restart (WriteLastRST above),
+# 'checkpoint' adds the pressure files Restart.py needs, every 730 hours unless
+# dump_interval says otherwise, 'debug' also writes CLM output. Pass the dump_interval
+# used to Restart.py. Set Solver.PrintMask in the parameter file to print a mask for
+# mask_file. netcdf_output below switches the PFB pressure and CLM files off.
+#-----------------------------------------------------------------------------------------
+
+output_keys = ['PrintPressure', 'PrintCLM', 'PrintSaturation', 'PrintVelocities', \
+               'PrintSubsurfData', 'PrintMask', 'WriteCLMBinary', \
+               'WriteSiloSpecificStorage', 'WriteSiloMannings', 'WriteSiloMask', \
+               'WriteSiloSlopes', 'WriteSiloSubsurfData', 'WriteSiloSaturation', \
+               'WriteSiloPressure', 'WriteSiloEvapTrans', 'WriteSiloEvapTransSum', \
+               'WriteSiloOverlandSum', 'WriteSiloCLM']
+
+output_modes = {
+    'production' : [],
+    'checkpoint' : ['PrintPressure'],
+    'debug'      : ['PrintPressure', 'PrintCLM'],
+}
+
+def set_output(model, mode):
+
+    if mode not in output_modes:
+        raise RuntimeError('output_mode must be one of ' + ', '.join(output_modes))
+
+    for key in output_keys:
+        setattr(model.Solver, key, key in output_modes[mode])
+
+set_output(model, output_mode)
+
+
+#-----------------------------------------------------------------------------------------
+# NetCDF output: all ranks write one shared file per NumStepsPerFile steps with
+# collective MPI-IO, replacing the per-step PFB pressure and CLM files. Chunks match
+# one rank's P x Q tile so each rank writes its own chunk. Note that Restart.py looks
+# for PFB pressure files.
+#-----------------------------------------------------------------------------------------
+
+if netcdf_output:
+    model.NetCDF.NumStepsPerFile       = 24
+    model.NetCDF.WritePressure         = True
+    model.NetCDF.WriteSaturation       = False
+    model.NetCDF.WriteCLM              = True
+    model.NetCDF.CLMNumStepsPerFile    = 24
+    model.NetCDF.Chunking              = True
+    model.NetCDF.ChunkX                = -(-model.ComputationalGrid.NX // model.Process.Topology.P)
+    model.NetCDF.ChunkY                = -(-model.ComputationalGrid.NY // model.Process.Topology.Q)
+    model.NetCDF.ChunkZ                = model.ComputationalGrid.NZ
+    model.Solver.PrintPressure         = False
+    model.Solver.PrintCLM              = False
+
+
+#-----------------------------------------------------------------------------------------
+# Parameter file: keys in parameter_file (nested YAML in ParFlow key form, e.g.
+# Geom: {s1: {Perm: {Value: 0.3}}}) override anything set above, so calibration and
+# sweeps can change values without editing this script. The exception are the keys
+# other settings are derived from (Solver.MaxIter, CLM.ReuseCount, the dz list, the
+# topology and NetCDF chunks): change those through the user variables instead; a
+# parameter file or realization that sets one to a new value is rejected.
+#-----------------------------------------------------------------------------------------
+
+derived_keys = ['TimingInfo.StartTime', 'TimingInfo.StopTime', 'TimeStep.Value', \
+                'Process.Topology.P', 'Process.Topology.Q', 'Process.Topology.R', \
+                'ComputationalGrid.NX', 'ComputationalGrid.NY', 'ComputationalGrid.NZ', \
+                'dzScale.nzListNumber', 'Solver.CLM.ReuseCount', 'Solver.MaxIter']
+
+def derived_values(run):
+    return {key: reduce(getattr, key.split('.'), run) for key in derived_keys}
+
+def set_overrides(run, source, **kwargs):
+    before     = derived_values(run)
+    run.pfset(**kwargs)
+    changed    = [key for key, value in derived_values(run).items() if value != before[key]]
+
+    if changed:
+        raise RuntimeError(source + ' may not set ' + ', '.join(changed) + \
+                           '; change the user variables instead')
+
+if parameter_file is not None:
+    set_overrides(model, parameter_file, yaml_file = os.path.join(script_path, parameter_file))
+
+
+#-----------------------------------------------------------------------------------------
+# Stage and distribute input files over the processor topology, one forked process per
+# file (workers inherit the model, only file names are sent). model.dist rewrites the
+# staged copy in place, so a file is only copied and distributed again when its source
+# or the topology changed since it was last distributed (see dist_stamp_file), or the
+# staged file's PFB header does not hold one subgrid per rank.
+#-----------------------------------------------------------------------------------------
+
+dist_files         = [subsurface_file, flow_barrier_file, mannings_file, slope_x_file, slope_y_file, initial_file]
+dist_stamp_file    = os.path.join(output_abs_path, 'dist-stamp.json')
+topology           = [model.Process.Topology.P, model.Process.Topology.Q, model.Process.Topology.R]
+pfb_header         = struct.Struct('>3d3i3di')    # x y z, nx ny nz, dx dy dz, subgrids
+
+dist_stamp = {}
+if os.path.isfile(dist_stamp_file):
+    with open(dist_stamp_file) as f:
+        dist_stamp = json.load(f)
+
+def dist_key(file_name):
+    stat = os.stat(os.path.join(input_abs_path, file_name))
+    return [stat.st_mtime, stat.st_size] + topology
+
+def is_distributed(file_name):
+    staged = os.path.join(output_abs_path, file_name)
+    if not (os.path.isfile(staged) and os.path.isfile(staged + '.dist')):
+        return False
+
+    try:
+        with open(staged, 'rb') as f:
+            subgrids = pfb_header.unpack(f.read(pfb_header.size))[9]
+    except struct.error:
+        return False
+
+    return subgrids == topology[0] * topology[1] * topology[2]
+
+def stage_and_dist(file_name):
+    cp( os.path.join(input_abs_path, file_name) )
+    model.dist(file_name)
+
+dist_keys      = {f: dist_key(f) for f in dist_files}
+stale_files    = [f for f in dist_files if dist_stamp.get(f) != dist_keys[f] or not is_distributed(f)]
+stale_files.sort(key = lambda f: dist_keys[f][1], reverse = True)    # largest first
+
+if stale_files:
+    with ProcessPoolExecutor(max_workers = min(len(stale_files), os.cpu_count()), \
+                             mp_context = multiprocessing.get_context('fork')) as executor:
+        list(executor.map(stage_and_dist, stale_files))
+
+dist_stamp.update(dist_keys)
+
+with open(dist_stamp_file, 'w') as f:
+    json.dump(dist_stamp, f)
+
+
+#-----------------------------------------------------------------------------------------
+# Distribute the forcing files in place (NZ = MetFileNT) once per topology. A marker
+# file in forcing_path records the topology they were distributed for, and a file lock
+# makes concurrent jobs sharing the forcing wait instead of distributing it twice. All
+# jobs sharing forcing_path must use the same P x Q: forcing distributed for another
+# topology may still be read by a running job, so it is never redistributed here -
+# remove its .dist-PxQxR marker by hand once no job uses it.
+#-----------------------------------------------------------------------------------------
+
+def dist_forcing(path):
+    model.dist(path, NZ = model.Solver.CLM.MetFileNT)
+
+if distribute_forcing:
+    forcing_abs_path    = get_absolute_path(forcing_path)
+    forcing_marker      = os.path.join(forcing_abs_path, '.dist-' + 'x'.join(map(str, topology)))
+
+    with open(os.path.join(forcing_abs_path, '.dist.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        other_markers = [m for m in glob.glob(os.path.join(forcing_abs_path, '.dist-*')) if m != forcing_marker]
+        if other_markers:
+            raise RuntimeError('forcing in ' + forcing_abs_path + ' is distributed for '
+                               + os.path.basename(other_markers[0])[6:] + ', not '
+                               + 'x'.join(map(str, topology)))
+
+        if not os.path.isfile(forcing_marker):
+            forcing_files = glob.glob(os.path.join(forcing_abs_path, '**', 'NLDAS.*.pfb'), recursive = True)
+
+            with ProcessPoolExecutor(max_workers = os.cpu_count(), \
+                                     mp_context = multiprocessing.get_context('fork')) as executor:
+                list(executor.map(dist_forcing, forcing_files))
+
+            open(forcing_marker, 'w').close()
+
+
+#-----------------------------------------------------------------------------------------
+# Run and Unload the ParFlow output files. Solver.MaxIter allows twice the number of
+# timesteps in the run. A step gets few Newton iterations, so a bad step fails fast and
+# ParFlow halves its dt, up to MaxConvergenceFailures times (at most 9: beyond that dt
+# drops below BaseUnit / 1000 and time-cycle timing goes wrong); a run that still fails is
+# retried from the start with half the timestep (CLM reuses each forcing step for twice
+# as many timesteps). Keys are validated once up front, so only a failed ParFlow run is
+# retried, and CLM's clm.rst files are put back as they were before the first attempt
+# (CLM rewrites them daily and a restart run reads them at startup).
+#-----------------------------------------------------------------------------------------
+
+if mpi_async_progress:
+    os.environ['MPICH_ASYNC_PROGRESS']    = '1'
+
+max_retries    = 2
+
+def restore_clm_restart(clm_dir, saved_dir):
+    for path in glob.glob(os.path.join(clm_dir, 'clm.rst.*')):
+        os.remove(path)
+    for path in glob.glob(os.path.join(saved_dir, 'clm.rst.*')):
+        shutil.copy2(path, clm_dir)
+
+def run_with_retries(run):
+    if validate_keys and run.validate():
+        raise RuntimeError(run.get_name() + ' has invalid keys, see the validation output')
+
+    clm_dir      = get_absolute_path(str(run.Solver.CLM.CLMFileDir))
+    saved_dir    = os.path.join(clm_dir, 'retry-rst')
+
+    shutil.rmtree(saved_dir, ignore_errors = True)
+    os.makedirs(saved_dir)
+    for path in glob.glob(os.path.join(clm_dir, 'clm.rst.*')):
+        shutil.copy2(path, saved_dir)
+
+    for attempt in range(max_retries + 1):
+        try:
+            run.run(skip_validation = True)
+            break
+        except SystemExit:
+            if attempt == max_retries:
+                raise
+
+        print(f'ParFlow failed with TimeStep.Value = {run.TimeStep.Value}, retrying with half')
+        restore_clm_restart(clm_dir, saved_dir)
+        run.TimeStep.Value            = run.TimeStep.Value / 2
+        run.Solver.CLM.ReuseCount     = run.Solver.CLM.ReuseCount * 2
+        run.Solver.MaxIter            = 2 * int((stop_time - start_time) / run.TimeStep.Value)
+
+    shutil.rmtree(saved_dir)
+
+# For a parameter sweep the model is built once and cloned per realization, named
+# run_name-001, -002, ...; each writes its CLM output and clm.rst files to its own
+# clm_output_path/<name> directory, but all write pressure files to pf_output_path. To
+# restart a realization, call Restart.py with run_name = <name>, clm_path =
+# clm_output_path/<name> and a restart_path of its own (e.g. restart-files/<name>),
+# so each keeps its own pressure snapshots, log and step counter. With
+# parallel_realizations > 1 several samples run side by side in one job allocation
+# (parallel_realizations * nproc ranks), sharing the staged and distributed inputs.
+
+if realizations:
+    samples = []
+    for i, overrides in enumerate(realizations, start = 1):
+        sample = model.clone(f'{run_name}-{i:03d}')
+        clm_dir    = os.path.join(clm_output_path, sample.get_name())
+        mkdir(clm_dir)
+        sample.Solver.CLM.CLMFileDir    = clm_dir
+        set_overrides(sample, sample.get_name(), flat_map = overrides)
+        samples.append(sample)
+
+    with ThreadPoolExecutor(max_workers = parallel_realizations) as executor:
+        list(executor.map(run_with_retries, samples))
+else:
+    run_with_retries(model)